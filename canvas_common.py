@@ -0,0 +1,264 @@
+"""
+Helpers shared by the Canvas scripts in this folder:
+- Domain normalization
+- A pooled, retrying requests session
+- Link-header pagination over Canvas collection endpoints
+- An on-disk ETag cache for API responses
+- Filesystem-safe names, the per-folder download manifest, and progress reporting
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from functools import lru_cache
+from itertools import chain
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Set
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+if TYPE_CHECKING:
+    from tqdm import tqdm
+
+# Optional fast JSON parser for Canvas API responses (pip install orjson)
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+def normalize_domain(d: str) -> str:
+    d = d.strip()
+    if "://" in d:
+        return urlparse(d).netloc
+    return d.split("/")[0]
+
+
+def build_session(token: str, pool_size: int = 32) -> requests.Session:
+    s = requests.Session()
+    # requests already asks for gzip/deflate (and br/zstd when those packages are installed)
+    s.headers.update({"Authorization": f"Bearer {token}"})
+    retries = Retry(
+        total=5,
+        backoff_factor=1.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods={"GET", "HEAD"},
+        raise_on_status=False,
+        respect_retry_after_header=True,
+    )
+    # Matches canvas_grabber.py's build_session except on purpose in two ways:
+    # - pool_size is caller-chosen and may be below the worker count, so pool_block
+    #   keeps it a hard cap (overflow waits for a kept-alive connection rather than
+    #   opening a throwaway one with a fresh TLS handshake)
+    # - only https:// is mounted: every URL here is https://<domain>, and Canvas
+    #   file redirects are HTTPS too
+    adapter = HTTPAdapter(
+        max_retries=retries, pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True
+    )
+    s.mount("https://", adapter)
+    return s
+
+
+# rel="next" entry of an RFC 5988 Link header
+_NEXT_RE = re.compile(r'<([^>]+)>\s*;\s*rel="?next"?')
+
+
+def next_link(resp: requests.Response) -> Optional[str]:
+    """URL of the next page from a response's Link header, or None on the last page."""
+    m = _NEXT_RE.search(resp.headers.get("Link", ""))
+    return m.group(1) if m else None
+
+
+def iter_all(
+    session: requests.Session, url: str, params: Optional[dict] = None, expected: Optional[int] = None
+) -> Iterator[dict]:
+    """
+    Yield every item of a Canvas collection endpoint, one page at a time, following Link headers.
+    When the caller already knows the total (e.g. a module's items_count), pass it as expected:
+    pagination stops once that many items have arrived, without consulting the Link header.
+    Raises requests.HTTPError on any error status (callers check e.response.status_code).
+    """
+    seen = 0
+    while url:
+        resp = session.get(url, params=params, timeout=30)
+        resp.raise_for_status()
+        data = json_loads(resp.content)
+        page = data if isinstance(data, list) else data.get("items", [])
+        if isinstance(page, list):
+            yield from page
+            seen += len(page)
+        # A short page alone doesn't prove it's the last one: Canvas may cap per_page below
+        # what was asked for, so only a known total can end pagination early
+        if expected is not None and seen >= expected:
+            break
+        # pagination
+        url = next_link(resp)
+        params = None  # subsequent pages already contain query in the next URL
+
+
+def get_all(
+    session: requests.Session, url: str, params: Optional[dict] = None, expected: Optional[int] = None
+) -> List[dict]:
+    """Fetch all pages for a Canvas collection endpoint into one list."""
+    return list(iter_all(session, url, params, expected))
+
+
+class ETagCache:
+    """
+    On-disk cache of Canvas API responses keyed by full URL.
+    Entries are revalidated with If-None-Match, so unchanged data costs a 304.
+    Only entries looked up or stored during this run are saved, so the file stays
+    the size of one run's requests instead of growing with every course ever opened.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Optional[Dict[str, dict]] = None
+        self._touched: Set[str] = set()
+        self._dirty = False
+
+    def _load(self) -> Dict[str, dict]:
+        if self._entries is None:
+            try:
+                self._entries = json.loads(self.path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def get(self, url: str) -> Optional[dict]:
+        with self._lock:
+            self._touched.add(url)
+            return self._load().get(url)
+
+    def put(self, url: str, etag: str, body: Any, next_url: Optional[str]) -> None:
+        with self._lock:
+            self._touched.add(url)
+            self._load()[url] = {"etag": etag, "body": body, "next": next_url}
+            self._dirty = True
+
+    def save(self) -> None:
+        with self._lock:
+            if self._entries is None:
+                return
+            kept = {url: e for url, e in self._entries.items() if url in self._touched}
+            if not self._dirty and len(kept) == len(self._entries):
+                return
+            self._entries = kept
+            data = json.dumps(kept)
+            self._dirty = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(data, encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+# Characters not allowed in Windows/macOS/Linux filenames, mapped to "_"
+_SANITIZE_TABLE = str.maketrans(dict.fromkeys('<>:"/\\|?*' + "".join(map(chr, range(32))), "_"))
+
+
+@lru_cache(maxsize=1024)
+def sanitize(name: str) -> str:
+    return name.translate(_SANITIZE_TABLE).strip(" .")
+
+
+# "/api/v1/files/123" also contains "/files/123", so one pattern covers both
+_FILE_ID_RE = re.compile(r"/files/(\d+)")
+
+
+def find_file_ids_in_html(html: str) -> Set[int]:
+    """
+    Find Canvas file IDs inside Page HTML. Handles both:
+      - /files/123456 (with or without /download)
+      - /api/v1/files/123456
+    """
+    return {int(m.group(1)) for m in _FILE_ID_RE.finditer(html)}
+
+
+class ProgressWriter:
+    """
+    Write-through file wrapper that advances a tqdm bar at most once per interval seconds,
+    so shutil.copyfileobj can drive the copy loop in C and still show progress, and
+    concurrent downloads sharing one bar don't contend on its lock and redraw.
+    """
+
+    def __init__(self, fh, pbar: tqdm, interval: float) -> None:
+        self._write = fh.write
+        self._update = pbar.update
+        self._interval = interval
+        self._pending = 0
+        self._last = time.monotonic()
+
+    def write(self, data: bytes) -> int:
+        n = self._write(data)
+        self._pending += len(data)
+        if time.monotonic() - self._last >= self._interval:
+            self.flush_progress()
+        return n
+
+    def flush_progress(self) -> None:
+        if self._pending:
+            self._update(self._pending)
+            self._pending = 0
+        self._last = time.monotonic()
+
+
+MANIFEST_NAME = ".manifest.json"
+
+
+def load_manifest(out_dir: Path) -> Dict[str, dict]:
+    """Read the {file id: {"name", "size", ...}} record of files already saved in out_dir."""
+    try:
+        return json.loads((out_dir / MANIFEST_NAME).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(out_dir: Path, manifest: Dict[str, dict]) -> None:
+    path = out_dir / MANIFEST_NAME
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def is_complete(path: Path, size: int) -> bool:
+    """True when path already holds a file of the expected (non-zero) size."""
+    return bool(size) and path.is_file() and path.stat().st_size == size
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    """Hard-link src to dst, copying instead when linking fails (e.g. across devices)."""
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+_CHOICE_RE = re.compile(r"\s*(\d+)\s*(?:-\s*(\d+))?\s*")
+
+
+def parse_choices(raw: str, maxnum: int) -> List[int]:
+    """
+    Parse input like "8,9,6" (and supports ranges like "5-7").
+    Returns a unique, ordered list of valid module numbers.
+    """
+    ranges = []
+    for part in raw.split(","):
+        m = _CHOICE_RE.fullmatch(part)
+        if not m:
+            continue
+        s = int(m.group(1))
+        e = int(m.group(2) or s)
+        if s > e:
+            s, e = e, s
+        ranges.append(range(max(s, 1), min(e, maxnum) + 1))
+    # dict.fromkeys dedupes while keeping first-seen order
+    return list(dict.fromkeys(chain.from_iterable(ranges)))
@@ -18,29 +18,58 @@ Usage:
 from __future__ import annotations
 
 import argparse
+import atexit
 import os
-import re
+import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Optional, Set, Tuple
-from urllib.parse import urlparse
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-import requests
-from requests.adapters import HTTPAdapter, Retry
+import urllib3
 from tqdm import tqdm
 
+# Optional HTTP/2 client: niquests is a drop-in for requests that multiplexes
+# the many small Canvas API calls over one connection (pip install niquests)
+try:
+    import niquests as requests
+    from niquests.adapters import HTTPAdapter, Retry
+except ImportError:
+    import requests
+    from requests.adapters import HTTPAdapter, Retry
+
+from canvas_common import (
+    ETagCache,
+    ProgressWriter,
+    find_file_ids_in_html,
+    is_complete,
+    json_loads,
+    link_or_copy,
+    load_manifest,
+    next_link,
+    normalize_domain,
+    parse_choices,
+    sanitize,
+    save_manifest,
+)
+
+# Concurrent Canvas API requests per module (metadata, pages, assignments)
+MAX_WORKERS = 16
+# Concurrent file downloads per module
+MAX_DOWNLOADS = 8
+# Read size when streaming file bodies to disk
+CHUNK_SIZE = 1024 * 1024
+# Minimum seconds between progress-bar updates from one download
+PROGRESS_INTERVAL = 0.2
 
-# ----------------- Utilities -----------------
-
-def normalize_domain(d: str) -> str:
-    d = d.strip()
-    if "://" in d:
-        return urlparse(d).netloc
-    return d.split("/")[0]
 
+# ----------------- Utilities -----------------
 
+# Kept here rather than in canvas_common: this session may be niquests (HTTP/2),
+# and get_json below routes every API call through the ETag cache
 def build_session(token: str) -> requests.Session:
     s = requests.Session()
+    # requests already asks for gzip/deflate (and br/zstd when those packages are installed)
     s.headers.update({"Authorization": f"Bearer {token}"})
     retries = Retry(
         total=5,
@@ -48,131 +77,97 @@ def build_session(token: str) -> requests.Session:
         status_forcelist=[429, 500, 502, 503, 504],
         allowed_methods={"GET", "HEAD"},
         raise_on_status=False,
+        respect_retry_after_header=True,
     )
-    adapter = HTTPAdapter(max_retries=retries)
+    # Sized above MAX_WORKERS so pooled workers never wait on a free connection
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=32, pool_maxsize=32, pool_block=False)
     s.mount("https://", adapter)
     s.mount("http://", adapter)
     return s
 
 
+_etags = ETagCache(Path.home() / ".cache" / "canvas_grabber" / "etags.json")
+
+
+def get_json(session: requests.Session, url: str, params: Optional[dict] = None) -> Tuple[Any, Optional[str]]:
+    """GET a Canvas endpoint via the ETag cache. Returns (data, next page URL)."""
+    key = requests.Request("GET", url, params=params).prepare().url
+    cached = _etags.get(key)
+    headers = {"If-None-Match": cached["etag"]} if cached else None
+    resp = session.get(url, params=params, headers=headers, timeout=30)
+    if resp.status_code == 304 and cached:
+        return cached["body"], cached["next"]
+    resp.raise_for_status()
+    data = json_loads(resp.content)
+    next_url = next_link(resp)
+    etag = resp.headers.get("ETag")
+    if etag:
+        _etags.put(key, etag, data, next_url)
+    return data, next_url
+
+
 def get_all(session: requests.Session, url: str, params: Optional[dict] = None) -> List[dict]:
     """Fetch all pages for a Canvas collection endpoint using Link headers."""
     results: List[dict] = []
     while url:
-        resp = session.get(url, params=params, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
+        data, url = get_json(session, url, params)
         if isinstance(data, list):
             results.extend(data)
         else:
             items = data.get("items", [])
             if isinstance(items, list):
                 results.extend(items)
-        # pagination
-        link = resp.headers.get("Link", "")
-        next_url = None
-        for part in link.split(","):
-            segs = [s.strip() for s in part.split(";")]
-            if len(segs) < 2:
-                continue
-            href = segs[0].strip("<> ")
-            rel = None
-            for attr in segs[1:]:
-                if attr.startswith("rel="):
-                    rel = attr.split("=", 1)[1].strip('"')
-            if rel == "next":
-                next_url = href
-        url = next_url
         params = None
     return results
 
 
-_illegal = r'[<>:"/\\|?*\x00-\x1F]'
-def sanitize(name: str) -> str:
-    return re.sub(_illegal, "_", name).strip(" .")
-
-
-def find_file_ids_in_html(html: str) -> Set[int]:
-    """
-    Find Canvas file IDs inside Page HTML. Handles both:
-      - /files/123456 (with or without /download)
-      - /api/v1/files/123456
-    """
-    ids: Set[int] = set()
-    for m in re.finditer(r"/files/(\d+)", html):
-        try:
-            ids.add(int(m.group(1)))
-        except ValueError:
-            pass
-    for m in re.finditer(r"/api/v1/files/(\d+)", html):
+def fetch_json(session: requests.Session, url: str) -> Optional[dict]:
+    """GET a single Canvas object. Returns None when access is forbidden (403)."""
+    try:
+        data, _ = get_json(session, url)
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 403:
+            return None
+        raise
+    return data
+
+
+def _write_body(resp: requests.Response, target_path: Path, pbar: tqdm) -> None:
+    # copyfileobj keeps the read/write loop in C; decode_content undoes any gzip
+    # (os.sendfile/splice can't help: bodies arrive TLS-encrypted, and Linux
+    # sendfile won't read from a socket, so userspace must see every byte)
+    resp.raw.decode_content = True
+    total = int(resp.headers.get("Content-Length") or 0)
+    # A CHUNK_SIZE buffer coalesces short reads and lets full blocks skip the memcpy
+    with open(target_path, "wb", buffering=CHUNK_SIZE) as fh:
+        # Reserve the full size up front so the filesystem can allocate contiguous
+        # extents; skipped for encoded bodies, whose Content-Length is compressed
+        if total and hasattr(os, "posix_fallocate") and not resp.headers.get("Content-Encoding"):
+            try:
+                os.posix_fallocate(fh.fileno(), 0, total)
+            except OSError:
+                pass  # e.g. filesystem without fallocate support
+        writer = ProgressWriter(fh, pbar, PROGRESS_INTERVAL)
         try:
-            ids.add(int(m.group(1)))
-        except ValueError:
-            pass
-    return ids
+            shutil.copyfileobj(resp.raw, writer, CHUNK_SIZE)
+        finally:
+            # Cut any reserved-but-unwritten tail, so a cut-off transfer can't pass
+            # is_complete() as a full-size file on the next run
+            fh.truncate()
+        writer.flush_progress()
 
 
-def download_to(session: requests.Session, url: str, target_path: Path) -> None:
+def download_to(session: requests.Session, url: str, target_path: Path, pbar: tqdm) -> None:
+    """Stream url into target_path, reporting bytes to the shared progress bar."""
+    # 429s (honoring Retry-After) and 5xx are retried by the session's Retry policy
     with session.get(url, stream=True, timeout=60) as resp:
-        if resp.status_code == 429:
-            import time
-            time.sleep(int(resp.headers.get("Retry-After", "3")))
-            resp.close()
-            r2 = session.get(url, stream=True, timeout=60)
-            r2.raise_for_status()
-            total = int(r2.headers.get("Content-Length") or 0)
-            with open(target_path, "wb") as fh:
-                pbar = tqdm(total=total or None, unit="B", unit_scale=True, desc=target_path.name, leave=False)
-                for chunk in r2.iter_content(chunk_size=262_144):
-                    if chunk:
-                        fh.write(chunk)
-                        pbar.update(len(chunk))
-                pbar.close()
-            return
-
         resp.raise_for_status()
-        total = int(resp.headers.get("Content-Length") or 0)
-        with open(target_path, "wb") as fh:
-            pbar = tqdm(total=total or None, unit="B", unit_scale=True, desc=target_path.name, leave=False)
-            for chunk in resp.iter_content(chunk_size=262_144):
-                if chunk:
-                    fh.write(chunk)
-                    pbar.update(len(chunk))
-            pbar.close()
-
-
-def parse_choices(raw: str, maxnum: int) -> List[int]:
-    """
-    Parse input like "8,9,6" (and supports ranges like "5-7").
-    Returns a unique, ordered list of valid module numbers.
-    """
-    nums: List[int] = []
-    seen = set()
-    for part in raw.split(","):
-        part = part.strip()
-        if not part:
-            continue
-        if "-" in part:
-            start, end = part.split("-", 1)
-            try:
-                s, e = int(start), int(end)
-                if s > e:
-                    s, e = e, s
-                for n in range(s, e + 1):
-                    if 1 <= n <= maxnum and n not in seen:
-                        seen.add(n)
-                        nums.append(n)
-            except ValueError:
-                continue
-        else:
-            try:
-                n = int(part)
-                if 1 <= n <= maxnum and n not in seen:
-                    seen.add(n)
-                    nums.append(n)
-            except ValueError:
-                continue
-    return nums
+        try:
+            _write_body(resp, target_path, pbar)
+        except urllib3.exceptions.HTTPError as e:
+            # Reading resp.raw skips requests' exception wrapping; re-raise a dropped
+            # connection or read timeout mid-body as the RequestException callers handle
+            raise requests.ConnectionError(e) from e
 
 
 # ----------------- Main -----------------
@@ -193,6 +188,7 @@ def main() -> None:
     domain = normalize_domain(args.domain)
     base = f"https://{domain}/api/v1"
     session = build_session(token)
+    atexit.register(_etags.save)
 
     # Course
     cr = session.get(f"{base}/courses/{args.course_id}", timeout=30)
@@ -203,7 +199,7 @@ def main() -> None:
         print("Course not found (404). Check course ID/enrollment.", file=sys.stderr)
         sys.exit(4)
     cr.raise_for_status()
-    course = cr.json()
+    course = json_loads(cr.content)
     course_name = course.get("name") or f"course_{args.course_id}"
     print(f"📚 {course_name} (id={course.get('id')})\n")
 
@@ -235,6 +231,8 @@ def main() -> None:
 
     grand_downloaded = 0
     grand_skipped = 0
+    # Course-wide: a file shared by several modules is downloaded only once
+    seen_fid_to_path: Dict[int, Path] = {}
 
     for choice in choices:
         mod = modules[choice - 1]
@@ -255,55 +253,84 @@ def main() -> None:
         # Gather file IDs
         file_ids: Set[int] = set()
 
-        # A) File items
-        for it in items:
-            if it.get("type") == "File" and it.get("content_id"):
-                try:
-                    file_ids.add(int(it["content_id"]))
-                except (KeyError, ValueError, TypeError):
-                    pass
-
-        # B) Page items -> parse body for file links
-        for it in items:
-            if it.get("type") == "Page":
-                slug = it.get("page_url")
-                if not slug:
-                    continue
-                pr = session.get(f"{base}/courses/{args.course_id}/pages/{slug}", timeout=30)
-                if pr.status_code == 403:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            # Single pass over items: File IDs are taken inline, while Page and
+            # Assignment lookups are submitted to the pool as soon as they're seen
+            page_futs = []
+            assignment_futs = []
+            for it in items:
+                kind = it.get("type")
+                if kind == "File" and it.get("content_id"):
+                    # A) File items
+                    try:
+                        file_ids.add(int(it["content_id"]))
+                    except (KeyError, ValueError, TypeError):
+                        pass
+                elif kind == "Page" and it.get("page_url"):
+                    # B) Page items -> parse body for file links
+                    page_url = f"{base}/courses/{args.course_id}/pages/{it['page_url']}"
+                    page_futs.append(pool.submit(fetch_json, session, page_url))
+                elif kind == "Assignment" and it.get("content_id"):
+                    # C) Assignment items -> attachments
+                    assignment_url = f"{base}/courses/{args.course_id}/assignments/{it['content_id']}"
+                    assignment_futs.append(pool.submit(fetch_json, session, assignment_url))
+
+            for fut in page_futs:
+                page = fut.result()
+                if page is not None:
+                    file_ids |= find_file_ids_in_html(page.get("body") or "")
+
+            for fut in assignment_futs:
+                adata = fut.result()
+                if adata is None:
                     continue
-                pr.raise_for_status()
-                page = pr.json()
-                body = page.get("body") or ""
-                file_ids |= find_file_ids_in_html(body)
-
-        # C) Assignment items -> attachments
-        for it in items:
-            if it.get("type") == "Assignment" and it.get("content_id"):
-                aid = it.get("content_id")
-                ar = session.get(f"{base}/courses/{args.course_id}/assignments/{aid}", timeout=30)
-                if ar.status_code == 403:
-                    continue
-                ar.raise_for_status()
-                adata = ar.json()
                 for att in (adata.get("attachments") or []):
                     fid = att.get("id")
                     if isinstance(fid, int):
                         file_ids.add(fid)
 
-        if not file_ids:
-            print("  (No downloadable Canvas files found in this module.)")
-            continue
+            if not file_ids:
+                print("  (No downloadable Canvas files found in this module.)")
+                continue
+
+            downloaded = 0
+            skipped = 0
+
+            manifest = load_manifest(mod_dir)
+
+            # Files already saved for an earlier module this run are linked, not re-fetched
+            for fid in sorted(file_ids & seen_fid_to_path.keys()):
+                src = seen_fid_to_path[fid]
+                target = mod_dir / src.name
+                size = src.stat().st_size
+                if target == src or is_complete(target, size):
+                    skipped += 1
+                else:
+                    link_or_copy(src, target)
+                    downloaded += 1
+                manifest[str(fid)] = {"name": target.name, "size": size}
+                file_ids.discard(fid)
+
+            # Files recorded in the manifest and still intact need no request at all
+            for fid in sorted(file_ids):
+                entry = manifest.get(str(fid))
+                if entry and is_complete(mod_dir / entry["name"], entry["size"]):
+                    seen_fid_to_path[fid] = mod_dir / entry["name"]
+                    file_ids.discard(fid)
+                    skipped += 1
+
+            # D) File metadata, fetched concurrently
+            metas: Dict[int, dict] = {}
+            futures = {pool.submit(fetch_json, session, f"{base}/files/{fid}"): fid for fid in file_ids}
+            for fut in as_completed(futures):
+                meta = fut.result()
+                if meta is not None:
+                    metas[futures[fut]] = meta
 
         # Download
-        downloaded = 0
-        skipped = 0
-        for fid in sorted(file_ids):
-            fr = session.get(f"{base}/files/{fid}", timeout=30)
-            if fr.status_code == 403:
-                continue
-            fr.raise_for_status()
-            meta = fr.json()
+        jobs: Dict[Path, Tuple[int, str, str, int]] = {}
+        for fid in sorted(metas):
+            meta = metas[fid]
             name = meta.get("display_name") or meta.get("filename") or f"file_{fid}"
             url = meta.get("url") or meta.get("download_url")
             size = int(meta.get("size") or 0)
@@ -311,15 +338,34 @@ def main() -> None:
                 continue
 
             target = mod_dir / sanitize(name)
-            if target.exists() and size and target.stat().st_size == size:
+            if is_complete(target, size):
+                seen_fid_to_path[fid] = target
+                manifest[str(fid)] = {"name": target.name, "size": size}
                 skipped += 1
                 continue
-
-            try:
-                download_to(session, url, target)
-                downloaded += 1
-            except requests.RequestException as e:
-                print(f"  ! Failed: {name} ({e})")
+            jobs[target] = (fid, name, url, size)
+
+        if jobs:
+            total = sum(size for _, _, _, size in jobs.values())
+            with tqdm(total=total or None, unit="B", unit_scale=True, desc="Downloading", leave=False,
+                      mininterval=PROGRESS_INTERVAL) as pbar, \
+                    ThreadPoolExecutor(max_workers=MAX_DOWNLOADS) as pool:
+                futures = {
+                    pool.submit(download_to, session, url, target, pbar): (fid, name, target, size)
+                    for target, (fid, name, url, size) in jobs.items()
+                }
+                for fut in as_completed(futures):
+                    fid, name, target, size = futures[fut]
+                    try:
+                        fut.result()
+                        downloaded += 1
+                    except requests.RequestException as e:
+                        pbar.write(f"  ! Failed: {name} ({e})")
+                        continue
+                    seen_fid_to_path[fid] = target
+                    manifest[str(fid)] = {"name": target.name, "size": size}
+                    save_manifest(mod_dir, manifest)
+        save_manifest(mod_dir, manifest)
 
         grand_downloaded += downloaded
         grand_skipped += skipped
@@ -19,128 +19,267 @@ from __future__ import annotations
 
 import argparse
 import os
-import re
+import shutil
 import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from email.message import Message
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Set
-from urllib.parse import urlparse
+from typing import Dict, List, Optional, Set, Tuple
 
 import requests
-from requests.adapters import HTTPAdapter, Retry
+import urllib3
 from tqdm import tqdm
 
+from canvas_common import (
+    ProgressWriter,
+    build_session,
+    find_file_ids_in_html,
+    get_all,
+    json_loads,
+    load_manifest,
+    normalize_domain,
+    sanitize,
+    save_manifest,
+)
+
+# Concurrent requests (page/assignment lookups, file downloads)
+MAX_WORKERS = 16
+# Block size for copying response bodies to disk
+CHUNK_SIZE = 1 << 20
+# Minimum seconds between progress-bar updates from one download (tqdm takes a lock per update)
+PROGRESS_INTERVAL = 0.5
+
 
 # ----------------- Utilities -----------------
 
-def normalize_domain(d: str) -> str:
-    d = d.strip()
-    if "://" in d:
-        return urlparse(d).netloc
-    return d.split("/")[0]
-
-
-def build_session(token: str) -> requests.Session:
-    s = requests.Session()
-    s.headers.update({"Authorization": f"Bearer {token}"})
-    retries = Retry(
-        total=5,
-        backoff_factor=1.2,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods={"GET", "HEAD"},
-        raise_on_status=False,
-    )
-    adapter = HTTPAdapter(max_retries=retries)
-    s.mount("https://", adapter)
-    s.mount("http://", adapter)
-    return s
+def _validator_path(part: Path) -> Path:
+    """Sidecar holding the If-Range validator of the body being written to part."""
+    return part.with_name(part.name + ".validator")
 
 
-def get_all(session: requests.Session, url: str, params: Optional[dict] = None) -> List[dict]:
-    """Fetch all pages for a Canvas collection endpoint using Link headers."""
-    results: List[dict] = []
-    while url:
-        resp = session.get(url, params=params, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
-        if isinstance(data, list):
-            results.extend(data)
+def _resume_validator(resp: requests.Response) -> Optional[str]:
+    """Strong ETag, else Last-Modified: the validators If-Range accepts."""
+    etag = resp.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return resp.headers.get("Last-Modified")
+
+
+def _finish(part: Path, target_path: Path) -> None:
+    part.replace(target_path)
+    _validator_path(part).unlink(missing_ok=True)
+
+
+def _stream(resp: requests.Response, part: Path, offset: int, desc: str) -> None:
+    """Copy a download body into part; a 206 reply appends at offset, a full 200 body replaces it."""
+    offset = offset if resp.status_code == 206 else 0
+    if not offset:
+        # Remember which version of the file this is, so a resume can insist on the same one
+        validator = _resume_validator(resp)
+        if validator:
+            _validator_path(part).write_text(validator, encoding="utf-8")
         else:
-            items = data.get("items", [])
-            if isinstance(items, list):
-                results.extend(items)
-        # pagination
-        link = resp.headers.get("Link", "")
-        next_url = None
-        for part in link.split(","):
-            segs = [s.strip() for s in part.split(";")]
-            if len(segs) < 2:
-                continue
-            href = segs[0].strip("<> ")
-            rel = None
-            for attr in segs[1:]:
-                if attr.startswith("rel="):
-                    rel = attr.split("=", 1)[1].strip('"')
-            if rel == "next":
-                next_url = href
-        url = next_url
-        params = None
-    return results
-
-
-_illegal = r'[<>:"/\\|?*\x00-\x1F]'
-def sanitize(name: str) -> str:
-    return re.sub(_illegal, "_", name).strip(" .")
-
-
-def find_file_ids_in_html(html: str) -> Set[int]:
+            _validator_path(part).unlink(missing_ok=True)
+    total = int(resp.headers.get("Content-Length") or 0)
+    # r+b rather than append mode: fallocate below grows the file, and appends would land after it
+    with open(part, "r+b" if offset else "wb") as fh:
+        fh.seek(offset)
+        # Reserve the rest of the file up front so the filesystem can allocate contiguous
+        # extents (skipped for encoded bodies, whose Content-Length is compressed), and
+        # hint that it is written front to back
+        if total and hasattr(os, "posix_fallocate") and not resp.headers.get("Content-Encoding"):
+            try:
+                os.posix_fallocate(fh.fileno(), offset, total)
+            except OSError:
+                pass  # e.g. filesystem without fallocate support
+        if hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(fh.fileno(), offset, total, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass  # only a hint
+        resp.raw.decode_content = True
+        with tqdm(total=(offset + total) or None, initial=offset, unit="B", unit_scale=True,
+                  desc=desc, leave=False, mininterval=PROGRESS_INTERVAL) as pbar:
+            writer = ProgressWriter(fh, pbar, PROGRESS_INTERVAL)
+            try:
+                shutil.copyfileobj(resp.raw, writer, CHUNK_SIZE)
+            except urllib3.exceptions.HTTPError as e:
+                # Reading resp.raw skips requests' exception wrapping; re-raise a dropped
+                # connection or read timeout mid-body as the RequestException callers handle
+                raise requests.ConnectionError(e) from e
+            finally:
+                # Cut any reserved-but-unwritten tail so the .part size stays a valid resume offset
+                fh.truncate()
+            writer.flush_progress()
+
+
+def download_to(session: requests.Session, url: str, target_path: Path) -> Optional[str]:
     """
-    Find Canvas file IDs inside Page HTML. Handles both:
-      - /files/123456/download ... (links in page body)
-      - data-api-endpoint=".../api/v1/files/123456"
+    Stream url into target_path and return the response ETag, if any.
+    Bytes go to a .part file first, so an interrupted download resumes with a Range request.
+    The resume carries If-Range, so a file that changed since comes back whole instead of
+    having its new tail stitched onto the old prefix.
     """
-    ids: Set[int] = set()
-    # /files/123456 (with optional /download)
-    for m in re.finditer(r"/files/(\d+)", html):
-        try:
-            ids.add(int(m.group(1)))
-        except ValueError:
-            pass
-    # api/v1/files/123456
-    for m in re.finditer(r"/api/v1/files/(\d+)", html):
-        try:
-            ids.add(int(m.group(1)))
-        except ValueError:
-            pass
-    return ids
-
-
-def download_to(session: requests.Session, url: str, target_path: Path) -> None:
-    with session.get(url, stream=True, timeout=60) as resp:
-        if resp.status_code == 429:
-            import time
-            time.sleep(int(resp.headers.get("Retry-After", "3")))
+    part = target_path.with_name(target_path.name + ".part")
+    offset = part.stat().st_size if part.exists() else 0
+    try:
+        validator = _validator_path(part).read_text(encoding="utf-8") if offset else None
+    except OSError:
+        validator = None
+    # Without a validator there's no telling whether .part still matches; start over
+    headers = {"Range": f"bytes={offset}-", "If-Range": validator} if validator else None
+    offset = offset if validator else 0
+    with session.get(url, stream=True, timeout=60, headers=headers) as resp:
+        # A server that ignores If-Range but honours Range still gives itself away by its ETag
+        etag = resp.headers.get("ETag")
+        stale = resp.status_code == 206 and validator.startswith('"') and etag and etag != validator
+        if resp.status_code == 416 or stale:
+            # .part no longer fits the remote file; start over
             resp.close()
-            r2 = session.get(url, stream=True, timeout=60)
-            r2.raise_for_status()
-            total = int(r2.headers.get("Content-Length") or 0)
-            with open(target_path, "wb") as fh:
-                pbar = tqdm(total=total or None, unit="B", unit_scale=True, desc=target_path.name, leave=False)
-                for chunk in r2.iter_content(chunk_size=262_144):
-                    if chunk:
-                        fh.write(chunk)
-                        pbar.update(len(chunk))
-                pbar.close()
-            return
+            part.unlink()
+            _validator_path(part).unlink(missing_ok=True)
+            return download_to(session, url, target_path)
 
+        # 429s (honoring Retry-After, in seconds or as an HTTP-date) and 5xx are
+        # retried by the session's Retry policy
         resp.raise_for_status()
-        total = int(resp.headers.get("Content-Length") or 0)
-        with open(target_path, "wb") as fh:
-            pbar = tqdm(total=total or None, unit="B", unit_scale=True, desc=target_path.name, leave=False)
-            for chunk in resp.iter_content(chunk_size=262_144):
-                if chunk:
-                    fh.write(chunk)
-                    pbar.update(len(chunk))
-            pbar.close()
+        _stream(resp, part, offset, target_path.name)
+        etag = resp.headers.get("ETag")
+
+    _finish(part, target_path)
+    return etag
+
+
+def resolve_item(session: requests.Session, base: str, course_id: int, it: dict, kind: str) -> Set[int]:
+    """Fetch a Page or Assignment item and return the Canvas file IDs it references."""
+    if kind == "page":
+        pr = session.get(f"{base}/courses/{course_id}/pages/{it['page_url']}", timeout=30)
+        if pr.status_code == 403:
+            return set()  # locked page
+        pr.raise_for_status()
+        page = json_loads(pr.content)
+        return find_file_ids_in_html(page.get("body") or "")
+
+    ar = session.get(f"{base}/courses/{course_id}/assignments/{it['content_id']}", timeout=30)
+    if ar.status_code == 403:
+        return set()
+    ar.raise_for_status()
+    adata = json_loads(ar.content)
+    return {att["id"] for att in (adata.get("attachments") or []) if isinstance(att.get("id"), int)}
+
+
+def in_manifest(out_dir: Path, entry: Optional[dict]) -> bool:
+    """True when a manifest entry's file is still on disk at the recorded size."""
+    if not entry or not entry.get("size"):
+        return False
+    target = out_dir / sanitize(entry.get("name") or "")
+    return target.is_file() and target.stat().st_size == entry["size"]
+
+
+def filename_from_disposition(value: str) -> Optional[str]:
+    """Filename from a Content-Disposition header, including RFC 2231 filename*= forms."""
+    if not value:
+        return None
+    msg = Message()
+    msg["Content-Disposition"] = value
+    return msg.get_filename() or None
+
+
+class TargetClaims:
+    """
+    Hands out one target path per file ID in out_dir. Two files with the same name would
+    otherwise share one .part and race each other's rename, so later ones get "name (id).ext".
+    """
+
+    def __init__(self, out_dir: Path) -> None:
+        self.out_dir = out_dir
+        self._owners: Dict[Path, int] = {}
+        self._lock = threading.Lock()
+
+    def claim(self, fid: int, name: str) -> Path:
+        target = self.out_dir / sanitize(name)
+        with self._lock:
+            if self._owners.setdefault(target, fid) != fid:
+                stem, ext = os.path.splitext(target.name)
+                target = target.with_name(f"{stem} ({fid}){ext}")
+                self._owners[target] = fid
+        return target
+
+
+def save_response(
+    session: requests.Session, resp: requests.Response, route: str, fid: int, name: str, claims: TargetClaims
+) -> Tuple[Optional[bool], Optional[dict]]:
+    """Save an open download-route response as name (same returns as fetch_meta_and_download)."""
+    # An encoded body's Content-Length is the compressed size, so it can't be compared on disk
+    size = 0 if resp.headers.get("Content-Encoding") else int(resp.headers.get("Content-Length") or 0)
+    target = claims.claim(fid, name)
+    entry = {"name": target.name, "size": size, "etag": resp.headers.get("ETag")}
+    if target.exists() and size and target.stat().st_size == size:
+        return False, entry
+
+    part = target.with_name(target.name + ".part")
+    try:
+        if part.exists():
+            # Resume through the Canvas route rather than resp.url: the signed URL lives on
+            # another host, and requests only drops the Authorization header on a redirect
+            resp.close()
+            entry["etag"] = download_to(session, route, target)
+        else:
+            _stream(resp, part, 0, target.name)
+            _finish(part, target)
+    except requests.RequestException as e:
+        tqdm.write(f"  ! Failed: {name} ({e})")
+        return None, None
+    entry["size"] = size or target.stat().st_size
+    return True, entry
+
+
+def fetch_meta_and_download(
+    session: requests.Session, base: str, fid: int, claims: TargetClaims
+) -> Tuple[Optional[bool], Optional[dict]]:
+    """
+    Look up one Canvas file and download it into claims.out_dir.
+    Returns (True if downloaded, False if already present, None if locked or failed)
+    together with the manifest entry for the file, when there is one.
+    """
+    # Fast path: the file's download route redirects straight to the signed URL and names
+    # the file in Content-Disposition, so the body can be streamed without a metadata lookup
+    route = f"{base.rsplit('/api/v1', 1)[0]}/files/{fid}/download?download_frd=1"
+    try:
+        resp = session.get(route, stream=True, timeout=60)
+    except requests.RequestException:
+        resp = None
+    if resp is not None:
+        with resp:
+            name = filename_from_disposition(resp.headers.get("Content-Disposition", "")) if resp.ok else None
+            if name:
+                return save_response(session, resp, route, fid, name, claims)
+
+    # Fallback (locked files, no filename, route unavailable): look the file up first
+    fr = session.get(f"{base}/files/{fid}", timeout=30)
+    if fr.status_code == 403:
+        return None, None  # locked file
+    fr.raise_for_status()
+    meta = json_loads(fr.content)
+    name = meta.get("display_name") or meta.get("filename") or f"file_{fid}"
+    url = meta.get("url") or meta.get("download_url")
+    size = int(meta.get("size") or 0)
+    if not url:
+        return None, None
+
+    target = claims.claim(fid, name)
+    entry = {"name": target.name, "size": size, "etag": None}
+    if target.exists() and size and target.stat().st_size == size:
+        return False, entry
+
+    try:
+        entry["etag"] = download_to(session, url, target)
+    except requests.RequestException as e:
+        tqdm.write(f"  ! Failed: {name} ({e})")
+        return None, None
+    entry["size"] = size or target.stat().st_size
+    return True, entry
 
 
 # ----------------- Main -----------------
@@ -171,7 +310,7 @@ def main() -> None:
         print("Course not found (404). Check course ID/enrollment.", file=sys.stderr)
         sys.exit(4)
     cr.raise_for_status()
-    course = cr.json()
+    course = json_loads(cr.content)
     course_name = course.get("name") or f"course_{args.course_id}"
     print(f"📚 {course_name} (id={course.get('id')})\n")
 
@@ -207,50 +346,37 @@ def main() -> None:
     print(f"\n➡️  Selected: {mod_title} (module #{choice})")
 
     # Get module items
-    items = get_all(session, f"{base}/courses/{args.course_id}/modules/{mid}/items", params={"per_page": 100})
+    items = get_all(
+        session,
+        f"{base}/courses/{args.course_id}/modules/{mid}/items",
+        params={"per_page": 100},
+        expected=mod.get("items_count"),
+    )
     if not items:
         print("This module has no items.")
         sys.exit(0)
 
-    # Resolve file IDs from items
+    # Resolve file IDs from items in one pass; network lookups start as soon as each item is seen
     file_ids: Set[int] = set()
-
-    # 1) File items → content_id is file_id
-    for it in items:
-        if it.get("type") == "File" and it.get("content_id"):
-            try:
-                file_ids.add(int(it["content_id"]))
-            except (KeyError, ValueError, TypeError):
-                pass
-
-    # 2) Page items → fetch page body → scrape file IDs
-    for it in items:
-        if it.get("type") == "Page":
-            slug = it.get("page_url")
-            if not slug:
-                # fallback: try to pull content id as page id (rare)
-                continue
-            pr = session.get(f"{base}/courses/{args.course_id}/pages/{slug}", timeout=30)
-            if pr.status_code == 403:
-                continue  # locked page
-            pr.raise_for_status()
-            page = pr.json()
-            body = page.get("body") or ""
-            file_ids |= find_file_ids_in_html(body)
-
-    # 3) Assignment items → attachments
-    for it in items:
-        if it.get("type") == "Assignment" and it.get("content_id"):
-            aid = it.get("content_id")
-            ar = session.get(f"{base}/courses/{args.course_id}/assignments/{aid}", timeout=30)
-            if ar.status_code == 403:
-                continue
-            ar.raise_for_status()
-            adata = ar.json()
-            for att in (adata.get("attachments") or []):
-                fid = att.get("id")
-                if isinstance(fid, int):
-                    file_ids.add(fid)
+    futures: List[Future] = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        for it in items:
+            t = it.get("type")
+            if t == "File":
+                # 1) File items → content_id is file_id
+                # Canvas returns content_id as an int; anything else is not a usable file ID
+                cid = it.get("content_id")
+                if isinstance(cid, int):
+                    file_ids.add(cid)
+            elif t == "Page" and it.get("page_url"):
+                # 2) Page items → fetch page body → scrape file IDs
+                futures.append(pool.submit(resolve_item, session, base, args.course_id, it, "page"))
+            elif t == "Assignment" and it.get("content_id"):
+                # 3) Assignment items → attachments
+                futures.append(pool.submit(resolve_item, session, base, args.course_id, it, "assignment"))
+        wait(futures)
+    for fut in futures:
+        file_ids |= fut.result()
 
     if not file_ids:
         print("No downloadable files were found in this module (files may be external links or locked).")
@@ -261,31 +387,27 @@ def main() -> None:
     out_dir.mkdir(parents=True, exist_ok=True)
     print(f"\n📁 Saving to: {out_dir}")
 
-    # Fetch metadata & download
+    # Files recorded in the manifest and still complete on disk need no HTTP call at all
+    manifest = load_manifest(out_dir)
+    pending = [fid for fid in sorted(file_ids) if not in_manifest(out_dir, manifest.get(str(fid)))]
+    # Files kept from earlier runs hold on to their names, so a new same-named file can't overwrite them
+    claims = TargetClaims(out_dir)
+    for fid in file_ids.difference(pending):
+        claims.claim(fid, manifest[str(fid)]["name"])
+    skipped = len(file_ids) - len(pending)
+
+    # Fetch metadata & download, one worker per file
     downloaded = 0
-    skipped = 0
-    for fid in sorted(file_ids):
-        fr = session.get(f"{base}/files/{fid}", timeout=30)
-        if fr.status_code == 403:
-            continue  # locked file
-        fr.raise_for_status()
-        meta = fr.json()
-        name = meta.get("display_name") or meta.get("filename") or f"file_{fid}"
-        url = meta.get("url") or meta.get("download_url")
-        size = int(meta.get("size") or 0)
-        if not url:
-            continue
-
-        target = out_dir / sanitize(name)
-        if target.exists() and size and target.stat().st_size == size:
-            skipped += 1
-            continue
-
-        try:
-            download_to(session, url, target)
-            downloaded += 1
-        except requests.RequestException as e:
-            print(f"  ! Failed: {name} ({e})")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        results = pool.map(lambda fid: fetch_meta_and_download(session, base, fid, claims), pending)
+        for fid, (result, entry) in zip(pending, results):
+            if result is True:
+                downloaded += 1
+            elif result is False:
+                skipped += 1
+            if entry is not None:
+                manifest[str(fid)] = entry
+                save_manifest(out_dir, manifest)
 
     print(f"\n✅ Done. Downloaded: {downloaded}, skipped: {skipped}. Saved to: {out_dir}")
 
@@ -4,6 +4,7 @@ List Canvas course content (read-only):
 - Prints course name
 - Shows module titles with items (and their URLs)
 - Attempts to list files (will skip if 403)
+- Caches folder/file listings in ~/.cache/canvas_grabber/ and revalidates them with ETags
 
 Usage:
   export CANVAS_API_TOKEN="YOUR_TOKEN"
@@ -13,59 +14,21 @@ Usage:
 from __future__ import annotations
 
 import argparse
+import json
 import os
 import sys
-from typing import Dict, List, Optional
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
 
 import requests
 
+from canvas_common import build_session, get_all, iter_all, json_loads, next_link, normalize_domain, sanitize
 
-def normalize_domain(d: str) -> str:
-    d = d.strip()
-    if "://" in d:
-        return urlparse(d).netloc
-    return d.split("/")[0]
-
-
-def get_all(session: requests.Session, url: str, params: Optional[dict] = None) -> List[dict]:
-    """Fetch all pages for a Canvas collection endpoint using Link headers."""
-    results: List[dict] = []
-    while url:
-        resp = session.get(url, params=params, timeout=30)
-        if resp.status_code == 401:
-            raise requests.HTTPError("401 Unauthorized", response=resp)
-        if resp.status_code == 403:
-            raise requests.HTTPError("403 Forbidden", response=resp)
-        if resp.status_code == 404:
-            raise requests.HTTPError("404 Not Found", response=resp)
-        resp.raise_for_status()
-
-        data = resp.json()
-        if isinstance(data, list):
-            results.extend(data)
-        else:
-            items = data.get("items", [])
-            if isinstance(items, list):
-                results.extend(items)
-
-        # parse RFC5988 Link header
-        link = resp.headers.get("Link", "")
-        next_url = None
-        for part in link.split(","):
-            segs = [s.strip() for s in part.split(";")]
-            if len(segs) < 2:
-                continue
-            href = segs[0].strip("<> ")
-            rel = None
-            for attr in segs[1:]:
-                if attr.startswith("rel="):
-                    rel = attr.split("=", 1)[1].strip('"')
-            if rel == "next":
-                next_url = href
-        url = next_url
-        params = None  # subsequent pages already contain query in the next URL
-    return results
+# Concurrent per-module item lookups
+MAX_WORKERS = 16
+# Listings are cached per course under CACHE_ROOT/<domain>/<course id>/
+CACHE_ROOT = Path.home() / ".cache" / "canvas_grabber"
 
 
 def sizeof_fmt(num: int) -> str:
@@ -76,6 +39,55 @@ def sizeof_fmt(num: int) -> str:
     return f"{num:.1f} TB"
 
 
+def iter_all_cached(
+    session: requests.Session, url: str, params: Optional[dict], cache_file: Path
+) -> Iterator[dict]:
+    """
+    Like iter_all, but keeps the whole listing in cache_file alongside the first page's ETag.
+    If page 1 comes back 304 the cached listing is replayed and no further pages are fetched.
+    """
+    try:
+        cached = json_loads(cache_file.read_bytes())
+    except (OSError, ValueError):
+        cached = None
+    headers = {"If-None-Match": cached["etag"]} if cached and cached.get("etag") else None
+
+    resp = session.get(url, params=params, headers=headers, timeout=30)
+    if resp.status_code == 304 and cached:
+        yield from cached["items"]
+        return
+    resp.raise_for_status()
+
+    data = json_loads(resp.content)
+    items: List[dict] = data if isinstance(data, list) else data.get("items", [])
+    yield from items
+    next_url = next_link(resp)
+    if next_url:
+        for it in iter_all(session, next_url):
+            items.append(it)
+            yield it
+
+    etag = resp.headers.get("ETag")
+    if etag:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"etag": etag, "items": items}), encoding="utf-8")
+        os.replace(tmp, cache_file)
+
+
+def module_items(session: requests.Session, base: str, course_id: int, module: dict) -> List[dict]:
+    """Fetch a module's items, or an empty list if they can't be fetched."""
+    try:
+        return get_all(
+            session,
+            f"{base}/courses/{course_id}/modules/{module.get('id')}/items",
+            params={"per_page": 100},
+            expected=module.get("items_count"),
+        )
+    except requests.RequestException:
+        return []
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="List modules and files for a Canvas course.")
     parser.add_argument("--domain", required=True, help="Canvas domain (e.g., canvas.odu.edu)")
@@ -94,8 +106,7 @@ def main() -> None:
 
     domain = normalize_domain(args.domain)
     base = f"https://{domain}/api/v1"
-    session = requests.Session()
-    session.headers.update({"Authorization": f"Bearer {token}"})
+    session = build_session(token)
 
     # 1) Course summary
     try:
@@ -111,7 +122,7 @@ def main() -> None:
         print(f"Network error: {e}", file=sys.stderr)
         sys.exit(2)
 
-    course = cr.json()
+    course = json_loads(cr.content)
     cname = course.get("name", f"course_{args.course_id}")
     print(f"📚 Course: {cname} (id={course.get('id')})")
     print(f"    Code: {course.get('course_code')} | State: {course.get('workflow_state')}\n")
@@ -127,22 +138,17 @@ def main() -> None:
     if not modules:
         print("    (none visible to your account)")
     else:
-        for i, m in enumerate(modules[: args.limit_modules], start=1):
-            print(f"\n    {i:2d}. {m.get('name')}  [items: {m.get('items_count', '?')}]")
-            mid = m.get("id")
-            try:
-                items = get_all(
-                    session,
-                    f"{base}/courses/{args.course_id}/modules/{mid}/items",
-                    params={"per_page": 100},
-                )
-            except requests.RequestException:
-                items = []
-            for it in items:
-                title = it.get("title") or "(untitled)"
-                ttype = it.get("type")
-                url = it.get("html_url") or it.get("url") or ""
-                print(f"        - {title} ({ttype}) {url}")
+        shown = modules[: args.limit_modules]
+        # Item lists are fetched concurrently; map() still yields them in module order
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            all_items = pool.map(lambda m: module_items(session, base, args.course_id, m), shown)
+            for i, (m, items) in enumerate(zip(shown, all_items), start=1):
+                print(f"\n    {i:2d}. {m.get('name')}  [items: {m.get('items_count', '?')}]")
+                for it in items:
+                    title = it.get("title") or "(untitled)"
+                    ttype = it.get("type")
+                    url = it.get("html_url") or it.get("url") or ""
+                    print(f"        - {title} ({ttype}) {url}")
         if len(modules) > args.limit_modules:
             print(f"\n    … plus {len(modules) - args.limit_modules} more")
 
@@ -151,8 +157,18 @@ def main() -> None:
     # 3) Files grouped by folders (may be forbidden for student tokens)
     print("📂 Files by folder:")
     try:
+        # Only page 1 is revalidated, so a cached listing can be replayed stale: deleting a
+        # file, or changing one that has dropped past page 1 (files are sorted newest-first),
+        # leaves page 1 untouched. Delete the cache folder to force a full refetch
+        cache_dir = CACHE_ROOT / sanitize(domain) / str(args.course_id)
+
         # folders
-        folders = get_all(session, f"{base}/courses/{args.course_id}/folders", params={"per_page": 100})
+        folders = iter_all_cached(
+            session,
+            f"{base}/courses/{args.course_id}/folders",
+            {"per_page": 100},
+            cache_dir / "folders.json",
+        )
         folder_map: Dict[int, str] = {}
         for f in folders:
             fid = int(f.get("id"))
@@ -162,22 +178,21 @@ def main() -> None:
             rel = rel.strip("/") or "(Root)"
             folder_map[fid] = rel
 
-        # files
-        files = get_all(
+        # files, grouped as each page arrives so only one page is held besides by_folder
+        by_folder: Dict[str, List[dict]] = {}
+        for f in iter_all_cached(
             session,
             f"{base}/courses/{args.course_id}/files",
-            params={"per_page": 100, "sort": "updated_at", "order": "desc"},
-        )
-
-        if not files:
+            {"per_page": 100, "sort": "updated_at", "order": "desc"},
+            cache_dir / "files.json",
+        ):
+            folder_id = f.get("folder_id")
+            folder_name = folder_map.get(int(folder_id), "(Unknown folder)") if folder_id else "(Root)"
+            by_folder.setdefault(folder_name, []).append(f)
+
+        if not by_folder:
             print("    (no files)")
         else:
-            by_folder: Dict[str, List[dict]] = {}
-            for f in files:
-                folder_id = f.get("folder_id")
-                folder_name = folder_map.get(int(folder_id), "(Unknown folder)") if folder_id else "(Root)"
-                by_folder.setdefault(folder_name, []).append(f)
-
             for folder_name in sorted(by_folder.keys()):
                 print(f"  • {folder_name}")
                 for f in by_folder[folder_name]: